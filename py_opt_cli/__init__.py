@@ -1,122 +1,287 @@
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
-from requests.utils import parse_header_links
+from urllib3.util.retry import Retry
 import attr
 import yaml
 import click
 from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import difflib
+import functools
+import hashlib
 import json
 import logging
+import os
+import re
+import stat
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+    LIBYAML = True
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+    LIBYAML = False
 
 
 LOG = logging.getLogger(__name__)
 
 
 META_FILE = '.meta.yaml'
+META_FILE_BUFFER_SIZE = 1 << 16
+SYNC_FILE = '.sync.yaml'
 SERIALIZER = 'serializer'
 
 READ_ONLY = 'read_only'
 
+PULL_WORKERS = 16
+POOL_CONNECTIONS = 32
+PAGE_WORKERS = 8
+# The largest page the Optimizely v2 API will serve
+PAGE_SIZE = 100
+# How much of a non-JSON error body to keep in the raised error
+ERROR_BODY_LIMIT = 200
+
+NEXT_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="?next"?')
+LAST_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="?last"?')
+
+
+def decode_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
-def modifiable(field, value):
-    return not field.metadata.get(READ_ONLY, False) and value is not None
+def encode_json(obj, sort_keys=False):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, sort_keys=sort_keys).encode('utf-8')
 
 
-@attr.s
+@attr.s(slots=True)
 class LazyCollection():
     optimizely = attr.ib()
     cls = attr.ib()
     endpoint = attr.ib()
     params = attr.ib(default=None)
-    _items = attr.ib(default=None, init=False)
+    _items = attr.ib(default=attr.Factory(dict), init=False)
+    _loaded = attr.ib(default=False, init=False)
 
-    def items(self):
-        if self._items is None:
-            doc_type = self.endpoint.rstrip('s')
-            self._items = {}
+    def _load(self):
+        if not self._loaded:
+            url = 'https://api.optimizely.com/v2/{}'.format(self.endpoint)
             params = {
-                'per_page': 50,
+                'per_page': PAGE_SIZE,
             }
             if self.params is not None:
                 params.update(self.params)
-            response = self.optimizely.session.get(
-                'https://api.optimizely.com/v2/{}'.format(self.endpoint),
-                params=params,
-            )
-            while True:
-                response.raise_for_status()
-
-                for doc in response.json():
-                    doc_name = doc.get('name', '')
-                    doc_id = doc.get('id', '')
-                    LOG.debug(f'Parsing {doc_type}: {doc_name} ({doc_id})')
-                    try:
-                        obj = self.cls(**doc)
-                    except TypeError:
-                        LOG.exception(
-                            'Error fetching %s %s (%s) from Optimizely:\n%s',
-                            doc_type,
-                            doc_name,
-                            str(doc_id),
-                            json.dumps(doc, indent=2)
-                        )
-                    else:
-                        self._items[obj.id] = obj
-
-                link_header = response.headers.get('link')
-                next_url = None
-                if link_header is not None:
-                    for link in parse_header_links(link_header):
-                        if link['rel'] in ('next', 'last'):
-                            next_url = link['url']
-                            break
-
-                if next_url is not None:
-                    response = self.optimizely.session.get(next_url)
-                else:
-                    break
+            optimizely = self.optimizely
+
+            response = optimizely.get(url, params=params)
+            response.raise_for_status()
+            last_page = last_page_number(response)
+
+            if last_page is not None:
+                # The page count is known up front, so request the rest all at once
+                with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+                    pages = [
+                        executor.submit(optimizely.get, url, params=dict(params, page=page))
+                        for page in range(2, last_page + 1)
+                    ]
+                    self._add_page(response)
+                    for page in pages:
+                        response = page.result()
+                        response.raise_for_status()
+                        self._add_page(response)
+            else:
+                # Fetch the next page in the background while this one is parsed
+                with ThreadPoolExecutor(max_workers=1) as prefetcher:
+                    while response is not None:
+                        next_url = next_page_url(response)
+                        if next_url is not None:
+                            next_response = prefetcher.submit(optimizely.get, next_url)
+                        else:
+                            next_response = None
+
+                        self._add_page(response)
+
+                        if next_response is not None:
+                            response = next_response.result()
+                            response.raise_for_status()
+                        else:
+                            response = None
+
+            self._loaded = True
+
+    def _add_page(self, response):
+        doc_type = self.endpoint.rstrip('s')
+        for doc in decode_json(response.content):
+            doc_name = doc.get('name', '')
+            doc_id = doc.get('id', '')
+            LOG.debug(f'Parsing {doc_type}: {doc_name} ({doc_id})')
+            try:
+                obj = self.cls(**doc)
+            except TypeError:
+                LOG.exception(
+                    'Error fetching %s %s (%s) from Optimizely:\n%s',
+                    doc_type,
+                    doc_name,
+                    str(doc_id),
+                    json.dumps(doc, indent=2)
+                )
+            else:
+                self._items[obj.id] = obj
 
+    def items(self):
+        self._load()
         return self._items.items()
 
     def values(self):
-        for _, value in self.items():
-            yield value
+        self._load()
+        return self._items.values()
 
     def __iter__(self):
-        for key, _ in self.items():
-            yield key
+        self._load()
+        return iter(self._items)
 
     def __getitem__(self, key):
-        if self._items is not None and key in self._items:
+        if key in self._items:
             return self._items[key]
 
-        response = self.optimizely.session.get(
+        obj, _ = self.fetch(key)
+        return obj
+
+    def fetch(self, key, etag=None):
+        """
+        Fetch a single document, returning ``(document, etag)``.
+
+        If ``etag`` is given and the document hasn't changed since it was issued,
+        Optimizely answers 304 Not Modified and ``document`` is None.
+        """
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        response = self.optimizely.get(
             'https://api.optimizely.com/v2/{}/{}'.format(self.endpoint, key),
+            headers=headers,
         )
+        if response.status_code == 304:
+            return None, etag
         self.optimizely.raise_for_status(response)
-        return self.cls(**response.json())
+        obj = self.cls(**decode_json(response.content))
+        self._items[obj.id] = obj
+        return obj, response.headers.get('ETag')
 
     def __setitem__(self, key, value):
-        changes = attr.asdict(value, filter=modifiable)
-        response = self.optimizely.session.patch(
+        self.patch(key, modifiable_dict(value))
+
+    def patch(self, key, changes):
+        """
+        Update only the fields in ``changes`` on a single document, returning the
+        updated ``(document, etag)`` as Optimizely now stores it.
+        """
+        response = self.optimizely.patch(
             'https://api.optimizely.com/v2/{}/{}'.format(self.endpoint, key),
-            json=changes,
+            data=encode_json(changes),
+            headers={'Content-Type': 'application/json'},
         )
         self.optimizely.raise_for_status(response)
+        obj = self.cls(**decode_json(response.content))
+        self._items[obj.id] = obj
+        return obj, response.headers.get('ETag')
+
+
+def last_page_number(response):
+    link_header = response.headers.get('link', '')
+    if 'last' not in link_header:
+        return None
+    match = LAST_LINK_RE.search(link_header)
+    if match is None:
+        return None
+    try:
+        return int(parse_qs(urlparse(match.group(1)).query)['page'][0])
+    except (KeyError, ValueError):
+        return None
+
+
+def next_page_url(response):
+    link_header = response.headers.get('link', '')
+    # The last page has no next link; skip the regex for it
+    if 'next' not in link_header:
+        return None
+    match = NEXT_LINK_RE.search(link_header)
+    if match is None:
+        return None
+    return match.group(1)
 
 
 class Optimizely():
-    def __init__(self, token):
+    def __init__(self, token, use_cache=True):
+        self.use_cache = use_cache
+        self._collections = {}
         self.session = requests.Session()
         self.session.headers['Authorization'] = "Bearer {}".format(token)
+        self.set_concurrency(PULL_WORKERS)
+
+    def set_concurrency(self, max_requests):
+        """
+        Allow at most ``max_requests`` requests in flight at once, however many
+        threads are issuing them, and keep a pooled connection alive for each.
+        """
+        self._request_slots = threading.BoundedSemaphore(max_requests)
+        adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=max_requests,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        with self._request_slots:
+            return self.session.get(url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        with self._request_slots:
+            return self.session.patch(url, **kwargs)
 
     def raise_for_status(self, response):
-        if not response.ok:
-            raise HTTPError(response.json().get('message', response.reason), response=response)
+        if response.ok:
+            return
+        try:
+            message = decode_json(response.content).get('message', response.reason)
+        except (ValueError, AttributeError):
+            # Not every error comes from the API itself, e.g. an HTML page from a proxy
+            body = response.text[:ERROR_BODY_LIMIT].strip()
+            message = '{}: {}'.format(response.reason, body) if body else response.reason
+        raise HTTPError(message, response=response)
+
+    def collection(self, cls, endpoint, params=None):
+        """
+        Return the LazyCollection for ``endpoint``, reusing one already built for
+        the same query so documents it has loaded aren't fetched again.
+        """
+        if not self.use_cache:
+            return LazyCollection(self, cls, endpoint, params)
+
+        key = (endpoint, frozenset(params.items()) if params else frozenset())
+        if key not in self._collections:
+            self._collections[key] = LazyCollection(self, cls, endpoint, params)
+        return self._collections[key]
 
     def projects(self):
-        return LazyCollection(self, Project, 'projects')
+        return self.collection(Project, 'projects')
 
     def experiments(self, project_id=None):
         if project_id:
@@ -125,7 +290,7 @@ class Optimizely():
             }
         else:
             params = None
-        return LazyCollection(self, Experiment, 'experiments', params)
+        return self.collection(Experiment, 'experiments', params)
 
     def audiences(self, project_id=None):
         if project_id:
@@ -134,7 +299,7 @@ class Optimizely():
             }
         else:
             params = None
-        return LazyCollection(self, Audience, 'audiences', params)
+        return self.collection(Audience, 'audiences', params)
 
     def pages(self, project_id=None):
         if project_id:
@@ -143,7 +308,7 @@ class Optimizely():
             }
         else:
             params = None
-        return LazyCollection(self, Page, 'pages', params)
+        return self.collection(Page, 'pages', params)
 
     def events(self, project_id=None):
         if project_id:
@@ -153,7 +318,7 @@ class Optimizely():
             }
         else:
             params = None
-        return LazyCollection(self, Event, 'events', params)
+        return self.collection(Event, 'events', params)
 
 
 COLLECTION_CLS = 'collection_cls'
@@ -167,7 +332,7 @@ def subdocuments(cls, metadata=None):
         _metadata.update(metadata)
 
     return attr.ib(
-        convert=lambda docs: [cls(**doc) for doc in docs],
+        convert=lambda docs: [doc if isinstance(doc, cls) else cls(**doc) for doc in docs],
         metadata=_metadata,
     )
 
@@ -183,77 +348,118 @@ def subdocument(cls, metadata=None):
         _metadata.update(metadata)
 
     return attr.ib(
-        convert=lambda doc: cls(**doc),
+        convert=lambda doc: doc if isinstance(doc, cls) else cls(**doc),
         metadata=_metadata,
     )
 
 
+@functools.lru_cache(maxsize=None)
+def field_plan(cls):
+    """
+    Split the fields of an OptimizelyDocument class, once per class, into the
+    names stored in its meta file and ``(name, collection_cls, subdocument_cls,
+    serializer)`` for each field stored elsewhere.
+    """
+    meta_names = []
+    nested = []
+    for field in attr.fields(cls):
+        collection_cls = field.metadata.get(COLLECTION_CLS)
+        subdocument_cls = field.metadata.get(SUBDOCUMENT_CLS)
+        serializer = field.metadata.get(SERIALIZER)
+        if collection_cls is None and subdocument_cls is None and serializer is None:
+            meta_names.append(field.name)
+        else:
+            nested.append((field.name, collection_cls, subdocument_cls, serializer))
+    return tuple(meta_names), tuple(nested)
+
+
 class OptimizelyDocument(object):
+    # Declared so slots=True subclasses have no per-instance __dict__;
+    # _dirname memoizes the dirname property and isn't an attrs field
+    __slots__ = ('_dirname',)
 
     @classmethod
     def read_from_disk(cls, root):
         meta = read_meta_file(root)
+        _, nested = field_plan(cls)
 
-        for field in attr.fields(cls):
-            if COLLECTION_CLS in field.metadata:
+        for name, collection_cls, subdocument_cls, _ in nested:
+            if collection_cls is not None:
                 docs = []
-                subdir = root / field.name
-                if subdir.exists():
-                    for dirname in meta.get(field.name):
-                        docdir = subdir / dirname
-                        if not docdir.is_dir():
-                            continue
-                        change = field.metadata[COLLECTION_CLS].read_from_disk(docdir)
-                        docs.append(as_non_null_dict(change))
-                meta[field.name] = docs
-            elif SUBDOCUMENT_CLS in field.metadata:
-                subdir = root / field.name
+                try:
+                    with os.scandir(root / name) as entries:
+                        docdirs = {entry.name: entry.path for entry in entries if entry.is_dir()}
+                except FileNotFoundError:
+                    docdirs = {}
+                for dirname in meta.get(name, ()):
+                    docdir = docdirs.get(dirname)
+                    if docdir is None:
+                        continue
+                    # Handed over as documents rather than dicts, so they aren't rebuilt
+                    docs.append(collection_cls.read_from_disk(Path(docdir)))
+                meta[name] = docs
+            elif subdocument_cls is not None:
+                subdir = root / name
                 if subdir.is_dir():
-                    obj = field.metadata[SUBDOCUMENT_CLS].read_from_disk(subdir)
-                    meta[field.name] = as_non_null_dict(obj)
+                    meta[name] = subdocument_cls.read_from_disk(subdir)
 
         obj = cls(**meta)
 
-        for field in attr.fields(cls):
-            if SERIALIZER in field.metadata:
-                serializer = field.metadata[SERIALIZER](root, obj, field.name)
-                setattr(obj, field.name, serializer.read_from_disk())
+        for name, _, _, serializer in nested:
+            if serializer is not None:
+                setattr(obj, name, serializer(root, obj, name).read_from_disk())
 
         return obj
 
     def write_to_disk(self, root):
         if self.dirname is not None:
-            docroot = root / self.dirname
+            self.write_to_dir(root / self.dirname)
         else:
-            docroot = root
-        docroot.mkdir(parents=True, exist_ok=True)
-
-        meta = as_non_null_dict(self)
-
-        for field in attr.fields(self.__class__):
-            if COLLECTION_CLS in field.metadata:
-                objs = []
-                for obj in getattr(self, field.name):
-                    obj.write_to_disk(docroot / field.name)
-                    objs.append(obj.dirname)
-                meta[field.name] = objs
-            elif SUBDOCUMENT_CLS in field.metadata:
-                obj = getattr(self, field.name)
-                obj.write_to_disk(docroot / field.name)
-                meta.pop(field.name, None)
-            elif SERIALIZER in field.metadata:
-                serializer = field.metadata[SERIALIZER](docroot, self, field.name)
-                serializer.write_to_disk()
-                meta.pop(field.name, None)
+            self.write_to_dir(root)
+
+    def write_to_dir(self, docroot):
+        """
+        Write this document into ``docroot`` itself, whatever its dirname.
+        """
+        ensure_dir(docroot)
+
+        meta_names, nested = field_plan(self.__class__)
+
+        # Nested documents and serialized fields are written to their own files,
+        # so only the scalar fields of this document go into its meta file
+        meta = {}
+        for name in meta_names:
+            value = getattr(self, name)
+            if value is not None:
+                meta[name] = value
+
+        for name, collection_cls, subdocument_cls, serializer in nested:
+            if collection_cls is not None:
+                objs = getattr(self, name)
+                for obj in objs:
+                    obj.write_to_disk(docroot / name)
+                meta[name] = [obj.dirname for obj in objs]
+            elif subdocument_cls is not None:
+                getattr(self, name).write_to_disk(docroot / name)
+            else:
+                serializer(docroot, self, name).write_to_disk()
 
         write_meta_file(docroot, meta)
 
     @property
     def dirname(self):
+        # Read several times per write; documents aren't renamed once built
+        try:
+            return self._dirname
+        except AttributeError:
+            self._dirname = self.make_dirname()
+            return self._dirname
+
+    def make_dirname(self):
         return slugify("{} {}".format(self.name, self.id))
 
 
-@attr.s
+@attr.s(slots=True)
 class ConditionSerializer(object):
     root = attr.ib()
     obj = attr.ib()
@@ -264,29 +470,39 @@ class ConditionSerializer(object):
         return self.root / '{}.json'.format(self.fieldname)
 
     def read_from_disk(self):
-        with self.filename.open() as field_file:
-            try:
-                return json.dumps(json.load(field_file))
-            except json.JSONDecodeError:
-                # the value can be simply "everyone" or a JSON blob
-                return field_file.read()
+        try:
+            data = self.filename.read_bytes()
+        except FileNotFoundError:
+            # write_to_disk writes no file for a None value
+            return None
+        try:
+            # Re-encoded with json.dumps' default separators so the string
+            # compares equal to the one Optimizely returns
+            return json.dumps(decode_json(data))
+        except ValueError:
+            # the value can be simply "everyone" or a JSON blob
+            return data.decode('utf-8')
 
     def write_to_disk(self):
         data = getattr(self.obj, self.fieldname)
         if data is not None:
-            with self.filename.open('w') as field_file:
-                try:
-                    json.dump(
-                        json.loads(data),
-                        fp=field_file,
-                        indent=2,
-                    )
-                except json.JSONDecodeError:
-                    # the value can be simply "everyone" or a JSON blob
-                    field_file.write(data)
+            try:
+                data = json.dumps(decode_json(data), indent=2)
+            except ValueError:
+                # the value can be simply "everyone" or a JSON blob
+                pass
+            replace_file(self.filename, data.encode('utf-8'))
 
 
-@attr.s
+STATIC_CONTENT_EXTENSIONS = {
+    'custom_css': 'css',
+    'custom_code': 'js',
+    'insert_html': 'html',
+    'insert_image': 'html',
+}
+
+
+@attr.s(slots=True)
 class StaticContentSerializer(object):
     root = attr.ib()
     obj = attr.ib()
@@ -296,31 +512,29 @@ class StaticContentSerializer(object):
     def filename(self):
         extension = None
         if hasattr(self.obj, 'type'):
-            if self.obj.type == 'custom_css':
-                extension = 'css'
-            elif self.obj.type == 'custom_code':
-                extension = 'js'
-            elif self.obj.type in ('insert_html', 'insert_image'):
-                extension = 'html'
-        else:
-            if self.fieldname in ('activation_code', 'project_javascript'):
-                extension = 'js'
+            extension = STATIC_CONTENT_EXTENSIONS.get(self.obj.type)
+        elif self.fieldname in ('activation_code', 'project_javascript'):
+            extension = 'js'
         if extension is None:
             extension = 'txt'
         return self.root / '{}.{}'.format(self.fieldname, extension)
 
     def read_from_disk(self):
-        with self.filename.open() as field_file:
-            return field_file.read()
+        try:
+            data = self.filename.read_bytes()
+        except FileNotFoundError:
+            # write_to_disk writes no file for a None value, e.g. an attribute change
+            return None
+        # Decoded in one go, and as UTF-8 to match how write_to_disk encodes it
+        return data.decode('utf-8')
 
     def write_to_disk(self):
         data = getattr(self.obj, self.fieldname)
         if data is not None:
-            with self.filename.open('w') as field_file:
-                field_file.write(data)
+            replace_file(self.filename, data.encode('utf-8'))
 
 
-@attr.s
+@attr.s(slots=True)
 class WebSnippet(OptimizelyDocument):
     code_revision = attr.ib(metadata={READ_ONLY: True})
     enable_force_variation = attr.ib()
@@ -333,12 +547,11 @@ class WebSnippet(OptimizelyDocument):
     ip_filter = attr.ib(default=None)
     project_javascript = attr.ib(default=None, metadata={SERIALIZER: StaticContentSerializer})
 
-    @property
-    def dirname(self):
+    def make_dirname(self):
         return None
 
 
-@attr.s
+@attr.s(slots=True)
 class Project(OptimizelyDocument):
     name = attr.ib()
     confidence_threshold = attr.ib()
@@ -355,7 +568,7 @@ class Project(OptimizelyDocument):
     dcp_service_id = attr.ib(default=None)
 
 
-@attr.s
+@attr.s(slots=True)
 class Audience(OptimizelyDocument):
     project_id = attr.ib(metadata={READ_ONLY: True})
     archived = attr.ib()
@@ -369,7 +582,7 @@ class Audience(OptimizelyDocument):
     last_modified = attr.ib(metadata={READ_ONLY: True})
 
 
-@attr.s
+@attr.s(slots=True)
 class Page(OptimizelyDocument):
     edit_url = attr.ib()
     name = attr.ib()
@@ -386,7 +599,7 @@ class Page(OptimizelyDocument):
     page_type = attr.ib(default=None)
 
 
-@attr.s
+@attr.s(slots=True)
 class Event(OptimizelyDocument):
     archived = attr.ib()
     category = attr.ib()
@@ -404,7 +617,7 @@ class Event(OptimizelyDocument):
     last_modified = attr.ib(metadata={READ_ONLY: True}, default=None)
 
 
-@attr.s
+@attr.s(slots=True)
 class Change(OptimizelyDocument):
     dependencies = attr.ib()
     id = attr.ib()
@@ -425,23 +638,21 @@ class Change(OptimizelyDocument):
     src = attr.ib(default=None, metadata={READ_ONLY: True})
     value = attr.ib(default=None, metadata={SERIALIZER: StaticContentSerializer})
 
-    @property
-    def dirname(self):
+    def make_dirname(self):
         return slugify(self.id)
 
 
-@attr.s
+@attr.s(slots=True)
 class Action(OptimizelyDocument):
     changes = subdocuments(Change)
     page_id = attr.ib()
     share_link = attr.ib(default=None)
 
-    @property
-    def dirname(self):
+    def make_dirname(self):
         return slugify(str(self.page_id))
 
 
-@attr.s
+@attr.s(slots=True)
 class Variation(OptimizelyDocument):
     weight = attr.ib()
     actions = subdocuments(Action)
@@ -452,12 +663,11 @@ class Variation(OptimizelyDocument):
     key = attr.ib(default=None)
     name = attr.ib(default=None)
 
-    @property
-    def dirname(self):
+    def make_dirname(self):
         return slugify("{} {}".format(self.name, self.variation_id))
 
 
-@attr.s
+@attr.s(slots=True)
 class Experiment(OptimizelyDocument):
     changes = subdocuments(Change)
     created = attr.ib(metadata={READ_ONLY: True})
@@ -486,19 +696,108 @@ class Experiment(OptimizelyDocument):
 def write_meta_file(root, meta_document):
     meta_file = root / META_FILE
 
-    with meta_file.open('w') as meta_file_handle:
-        yaml.safe_dump(
-            {k: v for k, v in meta_document.items() if v is not None},
-            stream=meta_file_handle,
-            default_flow_style=False,
-        )
+    # Emitting into a string and writing it at once avoids one write() per YAML token
+    replace_file(meta_file, yaml.dump(
+        {k: v for k, v in meta_document.items() if v is not None},
+        Dumper=SafeDumper,
+        default_flow_style=False,
+    ).encode('utf-8'))
 
 
 def read_meta_file(root):
     meta_file = root / META_FILE
 
-    with meta_file.open() as meta_file_handle:
-        return yaml.safe_load(meta_file_handle)
+    with meta_file.open(buffering=META_FILE_BUFFER_SIZE) as meta_file_handle:
+        return yaml.load(meta_file_handle, Loader=SafeLoader)
+
+
+def write_sync_file(root, etag, digest):
+    sync_file = root / SYNC_FILE
+
+    replace_file(sync_file, yaml.dump(
+        {'etag': etag, 'digest': digest},
+        Dumper=SafeDumper,
+        default_flow_style=False,
+    ).encode('utf-8'))
+
+
+def read_sync_file(root):
+    sync_file = root / SYNC_FILE
+
+    try:
+        with sync_file.open() as sync_file_handle:
+            return yaml.load(sync_file_handle, Loader=SafeLoader) or {}
+    except FileNotFoundError:
+        return {}
+
+
+def document_digest(obj):
+    return hashlib.sha1(encode_json(as_non_null_dict(obj), sort_keys=True)).hexdigest()
+
+
+def yaml_lines(document):
+    lines = []
+    for key in sorted(document):
+        lines.extend(
+            yaml.dump(
+                {key: document[key]},
+                Dumper=SafeDumper,
+                default_flow_style=False,
+            ).splitlines()
+        )
+    return lines
+
+
+def replace_file(path, data):
+    # Write the whole file in one go next to its destination, then swap it in,
+    # so an interrupted pull never leaves a truncated file behind
+    if file_contains(path, data):
+        return
+    # Swap in the file a symlink points to rather than the link itself, and
+    # keep the permissions it had, as writing to it in place would
+    path = Path(os.path.realpath(path))
+    tmp_path = path.with_name(path.name + '.tmp')
+    write_bytes(tmp_path, data)
+    try:
+        os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+    except FileNotFoundError:
+        pass
+    os.replace(tmp_path, path)
+
+
+def file_contains(path, data):
+    # Rewriting identical files on every pull only bumps mtimes and wakes up
+    # editors and file watchers; the size check avoids most reads
+    try:
+        if os.stat(path).st_size != len(data):
+            return False
+        with open(path, 'rb') as existing:
+            return existing.read() == data
+    except FileNotFoundError:
+        return False
+
+
+def write_bytes(path, data):
+    # Unbuffered writes straight to the descriptor; Path.write_bytes sets up a
+    # buffered file object per call, which adds up over thousands of tiny files
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def ensure_dir(path):
+    # Path.mkdir(exist_ok=True) stats existing directories to check they are
+    # directories; the files written into them will fail loudly if they aren't
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        pass
+    except FileNotFoundError:
+        path.mkdir(parents=True, exist_ok=True)
 
 
 def slugify(directory):
@@ -506,38 +805,94 @@ def slugify(directory):
 
 
 def as_non_null_dict(obj):
-    return attr.asdict(obj, filter=lambda a, v: v is not None)
+    return document_dict(obj, False)
+
+
+def modifiable_dict(obj):
+    return document_dict(obj, True)
+
+
+def document_dict(obj, only_modifiable):
+    # Equivalent to attr.asdict filtered on non-null (and optionally non-read-only)
+    # values, without asdict's per-field reflection and filter callbacks
+    doc = {}
+    for name, is_collection, is_subdocument in dict_plan(obj.__class__, only_modifiable):
+        value = getattr(obj, name)
+        if value is None:
+            continue
+        if is_collection:
+            value = [document_dict(child, only_modifiable) for child in value]
+        elif is_subdocument:
+            value = document_dict(value, only_modifiable)
+        doc[name] = value
+    return doc
+
+
+@functools.lru_cache(maxsize=None)
+def dict_plan(cls, only_modifiable):
+    return tuple(
+        (field.name, COLLECTION_CLS in field.metadata, SUBDOCUMENT_CLS in field.metadata)
+        for field in attr.fields(cls)
+        if not (only_modifiable and field.metadata.get(READ_ONLY, False))
+    )
 
 
 @click.group()
 @click.password_option('--token', envvar='OPTIMIZELY_TOKEN')
 @click.option('--verbose', default=False, is_flag=True)
+@click.option(
+    '--no-cache', default=False, is_flag=True, help='Always fetch full documents from Optimizely',
+)
 @click.pass_context
-def cli(ctx, token, verbose):
+def cli(ctx, token, verbose, no_cache):
     log_level = logging.DEBUG if verbose else logging.INFO
     log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=log_level, format=log_format)
 
+    if not LIBYAML:
+        LOG.warning(
+            'PyYAML was built without libyaml; reading and writing meta files will be slow. '
+            'Reinstall pyyaml with the libyaml headers available to fix this.'
+        )
+
     if ctx.obj is None:
         ctx.obj = {}
 
-    ctx.obj['OPTIMIZELY'] = Optimizely(token)
+    ctx.obj['OPTIMIZELY'] = Optimizely(token, use_cache=not no_cache)
 
 
 @cli.command()
 @click.option('--root', default='.', type=click.Path(exists=True, file_okay=False))
+@click.option('--io-threads', type=click.IntRange(min=1), default=PULL_WORKERS)
 @click.pass_context
-def pull(ctx, root):
+def pull(ctx, root, io_threads):
     optimizely = ctx.obj['OPTIMIZELY']
+    # Page fetches run on their own threads, so the limit has to be on the session
+    optimizely.set_concurrency(io_threads)
     project_root = Path(root)
-    for project in optimizely.projects().values():
-        LOG.debug(f'Processing project: {project.name} ({project.id})')
-        project.write_to_disk(project_root)
-
-        for object_type in ('experiments', 'audiences', 'pages', 'events'):
-            obj_root = project_root / project.dirname / object_type
-            for obj in getattr(optimizely, object_type)(project.id).values():
-                obj.write_to_disk(obj_root)
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        fetches = {}
+        writes = []
+        for project in optimizely.projects().values():
+            LOG.debug(f'Processing project: {project.name} ({project.id})')
+            writes.append(executor.submit(
+                write_document, project_root / project.dirname, project, None,
+            ))
+
+            for object_type in ('experiments', 'audiences', 'pages', 'events'):
+                obj_root = project_root / project.dirname / object_type
+                collection = getattr(optimizely, object_type)(project.id)
+                fetches[executor.submit(collection.items)] = obj_root
+
+        # Writes are queued from here rather than from the fetch tasks, so no
+        # worker ever blocks waiting on another
+        for future in as_completed(fetches):
+            obj_root = fetches[future]
+            for _, obj in future.result():
+                writes.append(executor.submit(write_document, obj_root / obj.dirname, obj, None))
+
+        for future in as_completed(writes):
+            future.result()
 
 
 @cli.command('pull-experiment')
@@ -549,51 +904,158 @@ def pull_experiment(ctx, experiment):
 
 def pull_object(ctx, path, object_class, collection_name):
     optimizely = ctx.obj['OPTIMIZELY']
+    path = Path(path)
+
+    local = object_class.read_from_disk(path)
+
+    remote, etag = getattr(optimizely, collection_name)().fetch(
+        local.id, stored_etag(optimizely, path, local),
+    )
+    if remote is None:
+        click.secho("Already up to date.", fg='green')
+        return
+
+    write_document(path, remote, etag)
 
-    local = object_class.read_from_disk(Path(path))
-    remote = getattr(optimizely, collection_name)()[local.id]
 
-    remote.write_to_disk(Path(path).parent)
+def stored_etag(optimizely, path, local):
+    # The stored etag only describes the local copy if it hasn't been edited since
+    if optimizely.use_cache:
+        sync = read_sync_file(path)
+        if sync.get('digest') == document_digest(local):
+            return sync.get('etag')
+    return None
+
+
+def write_document(docroot, obj, etag):
+    # Written into docroot even if the document was renamed, so that a rename
+    # doesn't leave the old tree behind to be pushed again
+    obj.write_to_dir(docroot)
+    digest = document_digest(obj)
+    if etag is None:
+        # Listings carry no per-document etag, but one stored for the same
+        # content still describes it
+        sync = read_sync_file(docroot)
+        if sync.get('digest') == digest:
+            etag = sync.get('etag')
+    write_sync_file(docroot, etag, digest)
 
 
 @cli.command('push-experiment')
 @click.argument('experiment', type=click.Path(exists=True, file_okay=False))
-@click.option('--context-lines', '-n', type=int, default=3)
+@click.option(
+    '--context-lines', '-n', type=int, default=3,
+    help='Lines of context around each change; only applies with --full-diff',
+)
+@click.option(
+    '--full-diff', default=False, is_flag=True,
+    help='Show a unified diff of the changed fields instead of only what changed',
+)
 @click.pass_context
-def push_experiment(ctx, experiment, context_lines):
-    return push_object(ctx, experiment, Experiment, 'experiments', context_lines)
+def push_experiment(ctx, experiment, context_lines, full_diff):
+    return push_object(ctx, experiment, Experiment, 'experiments', context_lines, full_diff)
 
 
-def push_object(ctx, path, object_class, collection_name, context_lines):
+def push_object(ctx, path, object_class, collection_name, context_lines, full_diff=False):
     optimizely = ctx.obj['OPTIMIZELY']
+    path = Path(path)
 
-    local = object_class.read_from_disk(Path(path))
-    remote = getattr(optimizely, collection_name)()[local.id]
+    local = object_class.read_from_disk(path)
+
+    # Neither side changed since the last pull or push, so there is nothing to compare
+    remote, _ = getattr(optimizely, collection_name)().fetch(
+        local.id, stored_etag(optimizely, path, local),
+    )
+    if remote is None:
+        click.secho("No changes!", fg='green')
+        return
 
-    remote_doc = attr.asdict(remote, filter=modifiable)
-    local_doc = attr.asdict(local, filter=modifiable)
+    remote_doc = modifiable_dict(remote)
+    local_doc = modifiable_dict(local)
 
     if local_doc == remote_doc:
         click.secho("No changes!", fg='green')
     else:
-        for diffline in difflib.unified_diff(
-            yaml.dump(remote_doc, default_flow_style=False).splitlines(),
-            yaml.dump(local_doc, default_flow_style=False).splitlines(),
-            fromfile='remote',
-            tofile='local',
-            n=context_lines,
-        ):
-            if diffline.startswith(' '):
-                click.secho(diffline, fg='white')
-            elif diffline.startswith('-'):
-                click.secho(diffline, fg='red')
-            elif diffline.startswith('+'):
-                click.secho(diffline, fg='green')
-            elif diffline.startswith('?'):
-                click.secho(diffline, fg='yellow')
+        changed = changed_fields(remote_doc, local_doc)
+        if full_diff:
+            print_unified_diff(remote_doc, local_doc, changed, context_lines)
+        else:
+            print_dict_diff(remote_doc, local_doc)
 
         if click.confirm('Push these changes?'):
-            getattr(optimizely, collection_name)()[local.id] = local
+            remote, etag = getattr(optimizely, collection_name)().patch(
+                local.id,
+                patch_body(local_doc, changed),
+            )
+            # Leave the same files and etag behind that pulling the result would
+            write_document(path, remote, etag)
+
+
+def print_unified_diff(remote_doc, local_doc, changed, context_lines):
+    # Only render the top-level keys that differ; difflib is quadratic in the worst case
+    for diffline in difflib.unified_diff(
+        yaml_lines({key: value for key, value in remote_doc.items() if key in changed}),
+        yaml_lines({key: value for key, value in local_doc.items() if key in changed}),
+        fromfile='remote',
+        tofile='local',
+        n=context_lines,
+    ):
+        if diffline.startswith(' '):
+            click.secho(diffline, fg='white')
+        elif diffline.startswith('-'):
+            click.secho(diffline, fg='red')
+        elif diffline.startswith('+'):
+            click.secho(diffline, fg='green')
+        elif diffline.startswith('?'):
+            click.secho(diffline, fg='yellow')
+
+
+def print_dict_diff(remote_doc, local_doc):
+    for op, path, remote_value, local_value in dict_diff(remote_doc, local_doc):
+        click.secho('@@ {} @@'.format('.'.join(str(key) for key in path)), fg='yellow')
+        if op in '-~':
+            for line in yaml_lines({path[-1]: remote_value}):
+                click.secho('-' + line, fg='red')
+        if op in '+~':
+            for line in yaml_lines({path[-1]: local_value}):
+                click.secho('+' + line, fg='green')
+
+
+def dict_diff(a, b, path=()):
+    """
+    Yield ``(op, path, a_value, b_value)`` for every subtree that differs between ``a`` and ``b``,
+    where ``op`` is ``-`` (only in ``a``), ``+`` (only in ``b``) or ``~`` (changed).
+    """
+    if isinstance(a, dict) and isinstance(b, dict):
+        for key in sorted(set(a) | set(b), key=str):
+            if key not in b:
+                yield ('-', path + (key,), a[key], None)
+            elif key not in a:
+                yield ('+', path + (key,), None, b[key])
+            elif a[key] != b[key]:
+                yield from dict_diff(a[key], b[key], path + (key,))
+    elif isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        for index, (a_item, b_item) in enumerate(zip(a, b)):
+            if a_item != b_item:
+                yield from dict_diff(a_item, b_item, path + (index,))
+    else:
+        yield ('~', path, a, b)
+
+
+def changed_fields(remote_doc, local_doc):
+    """
+    The names of the top-level fields that differ between ``remote_doc`` and ``local_doc``.
+    """
+    return {
+        key for key in set(remote_doc) | set(local_doc)
+        if remote_doc.get(key) != local_doc.get(key)
+    }
+
+
+def patch_body(local_doc, changed):
+    # Fields that are only missing locally were never sent by a full PATCH
+    # either, so they aren't cleared remotely now
+    return {key: value for key, value in local_doc.items() if key in changed}
 
 
 @cli.command('pull-page')
@@ -605,10 +1067,17 @@ def pull_page(ctx, page):
 
 @cli.command('push-page')
 @click.argument('page', type=click.Path(exists=True, file_okay=False))
-@click.option('--context-lines', '-n', type=int, default=3)
+@click.option(
+    '--context-lines', '-n', type=int, default=3,
+    help='Lines of context around each change; only applies with --full-diff',
+)
+@click.option(
+    '--full-diff', default=False, is_flag=True,
+    help='Show a unified diff of the changed fields instead of only what changed',
+)
 @click.pass_context
-def push_page(ctx, page, context_lines):
-    return push_object(ctx, page, Page, 'pages', context_lines)
+def push_page(ctx, page, context_lines, full_diff):
+    return push_object(ctx, page, Page, 'pages', context_lines, full_diff)
 
 
 @cli.command('pull-project')
@@ -620,10 +1089,110 @@ def pull_project(ctx, project):
 
 @cli.command('push-project')
 @click.argument('project', type=click.Path(exists=True, file_okay=False))
-@click.option('--context-lines', '-n', type=int, default=3)
+@click.option(
+    '--context-lines', '-n', type=int, default=3,
+    help='Lines of context around each change; only applies with --full-diff',
+)
+@click.option(
+    '--full-diff', default=False, is_flag=True,
+    help='Show a unified diff of the changed fields instead of only what changed',
+)
 @click.pass_context
-def push_page(ctx, project, context_lines):
-    return push_object(ctx, project, Project, 'projects', context_lines)
+def push_page(ctx, project, context_lines, full_diff):
+    return push_object(ctx, project, Project, 'projects', context_lines, full_diff)
+
+
+PUSHABLE_COLLECTIONS = (
+    ('experiments', Experiment),
+    ('pages', Page),
+)
+
+
+@cli.command('push-all')
+@click.option('--root', default='.', type=click.Path(exists=True, file_okay=False))
+@click.option('--io-threads', type=click.IntRange(min=1), default=PULL_WORKERS)
+@click.pass_context
+def push_all(ctx, root, io_threads):
+    optimizely = ctx.obj['OPTIMIZELY']
+    optimizely.set_concurrency(io_threads)
+    project_root = Path(root)
+
+    candidates = []
+    for project_dir in sorted(project_root.iterdir()):
+        if not (project_dir / META_FILE).is_file():
+            continue
+        candidates.append((project_dir, Project, 'projects'))
+        for collection_name, object_class in PUSHABLE_COLLECTIONS:
+            collection_dir = project_dir / collection_name
+            if collection_dir.is_dir():
+                for path in sorted(collection_dir.iterdir()):
+                    if (path / META_FILE).is_file():
+                        candidates.append((path, object_class, collection_name))
+
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        reads = [
+            (path, collection_name, executor.submit(object_class.read_from_disk, path))
+            for path, object_class, collection_name in candidates
+        ]
+        paths_by_id = {}
+        for path, collection_name, future in reads:
+            try:
+                local = future.result()
+            except (OSError, TypeError, ValueError, yaml.YAMLError) as error:
+                click.secho('Skipping {}, which could not be read: {}'.format(
+                    path, error,
+                ), fg='red')
+                continue
+            paths_by_id.setdefault((collection_name, local.id), []).append((path, local))
+
+        diffs = []
+        for (collection_name, doc_id), copies in paths_by_id.items():
+            if len(copies) > 1:
+                # A stale copy left behind by a rename would undo the newer one's changes
+                click.secho('Skipping {} {}, found in more than one directory: {}'.format(
+                    collection_name, doc_id, ', '.join(str(path) for path, _ in copies),
+                ), fg='red')
+                continue
+            path, local = copies[0]
+            diffs.append((
+                path,
+                collection_name,
+                local,
+                executor.submit(diff_object, optimizely, path, local, collection_name),
+            ))
+
+        pushes = []
+        for path, collection_name, local, future in diffs:
+            changes = future.result()
+            if changes:
+                click.secho('{}: {}'.format(path, ', '.join(sorted(changes))), fg='yellow')
+                pushes.append((path, collection_name, local, changes))
+
+        if not pushes:
+            click.secho("No changes!", fg='green')
+            return
+
+        if click.confirm('Push {} changed documents?'.format(len(pushes))):
+            for future in as_completed([
+                executor.submit(patch_object, optimizely, path, collection_name, local, changes)
+                for path, collection_name, local, changes in pushes
+            ]):
+                future.result()
+
+
+def diff_object(optimizely, path, local, collection_name):
+    # Unchanged since it was last pulled or pushed, so there is nothing to send
+    if optimizely.use_cache and read_sync_file(path).get('digest') == document_digest(local):
+        return {}
+
+    remote = getattr(optimizely, collection_name)()[local.id]
+    local_doc = modifiable_dict(local)
+    return patch_body(local_doc, changed_fields(modifiable_dict(remote), local_doc))
+
+
+def patch_object(optimizely, path, collection_name, local, changes):
+    remote, etag = getattr(optimizely, collection_name)().patch(local.id, changes)
+    write_document(path, remote, etag)
 
 
 if __name__ == '__main__':